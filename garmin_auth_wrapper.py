@@ -1,142 +1,398 @@
 import sys
 import os
 import time
-import subprocess
-import json
 
-# Ensure we can import modules from the environment
-try:
-    import garth
-except ImportError:
-    print("[WRAPPER] Error: 'garth' module not found. Is it installed?")
-    sys.exit(1)
+# NOTE: garth (which drags in requests/urllib3/etc.), json, runpy and
+# traceback are all imported lazily at their point of use, so paths that
+# never need one of them never pay its import cost.
 
 # Configuration matching GarminDB's defaults
 GARMINDB_DIR = os.path.expanduser("~/.GarminDb")
 SESSION_DIR = os.path.join(GARMINDB_DIR, "garth_session")
 
-def main():
-    print("[WRAPPER] Starting Garmin Auth Wrapper...")
-    
-    # 1. Try to resume existing session
-    session_valid = False
+# Batched [WRAPPER] diagnostics: lines are collected and emitted in a single
+# sys.stdout.write at phase boundaries, halving write()/flush syscalls on the
+# pipe to server.js. Prompt lines ("Username:", "Password:") are still printed
+# directly so the regex in server.js sees them on their own write.
+_log_batch = []
+
+def _log(line):
+    _log_batch.append(line)
+
+def _flush_log():
+    if _log_batch:
+        sys.stdout.write("\n".join(_log_batch) + "\n")
+        del _log_batch[:]
+    sys.stdout.flush()
+
+# Sentinel recording the last successful session validation; if its mtime is
+# younger than the TTL we trust the session and skip the garth.resume disk I/O.
+VALIDATED_SENTINEL = os.path.join(SESSION_DIR, ".validated_at")
+VALIDATED_TTL_SECONDS = 10 * 60
+
+def _session_recently_validated():
+    try:
+        return os.stat(VALIDATED_SENTINEL).st_mtime > time.time() - VALIDATED_TTL_SECONDS
+    except OSError:
+        return False
+
+def _mark_session_validated():
+    try:
+        with open(VALIDATED_SENTINEL, 'w'):
+            pass
+        os.utime(VALIDATED_SENTINEL, None)
+    except OSError:
+        pass
+
+def _invalidate_session_sentinel():
+    try:
+        os.remove(VALIDATED_SENTINEL)
+    except OSError:
+        pass
+
+def _token_still_fresh():
+    """Peek at oauth2_token.json's expiry fields without building token objects.
+
+    Returns True when the access token has >60s left, or when it is expired
+    but the refresh token is still alive (garth.resume can refresh it).
+    """
+    try:
+        import json
+        with open(os.path.join(SESSION_DIR, "oauth2_token.json")) as f:
+            t = json.load(f)
+    except (OSError, ValueError):
+        return False
+    now = time.time()
+    if (t.get("expires_at", 0) - now) > 60:
+        return True
+    return t.get("refresh_token_expires_at", 0) > now
+
+# Leftover bytes from a previous os.read that arrived after the newline
+# (e.g. both credential lines delivered in one pipe chunk).
+_stdin_leftover = b''
+
+def _read_line():
+    """Read one line from fd 0 via os.read, skipping TextIOWrapper's
+    decoding machinery -- the credentials arrive over a pipe from server.js."""
+    global _stdin_leftover
+    buf = _stdin_leftover
+    while b'\n' not in buf:
+        chunk = os.read(0, 4096)
+        if not chunk:
+            break
+        buf += chunk
+    line, sep, rest = buf.partition(b'\n')
+    _stdin_leftover = rest if sep else b''
+    return line.decode('utf-8', 'ignore').strip()
+
+# Resolved path of garmindb_cli.py, cached so the PATH walk happens at most once.
+_TARGET_CLI_PATH = None
+
+# On-disk cache of the resolved path, so later invocations skip the PATH walk too.
+_CACHED_CLI_PATH = os.path.join(GARMINDB_DIR, ".cli_path")
+
+def _resolve_target_cli():
+    """Locate garmindb_cli.py on PATH (walked once, then cached in memory and on disk)."""
+    global _TARGET_CLI_PATH
+    if _TARGET_CLI_PATH:
+        return _TARGET_CLI_PATH
+
+    # A previous invocation may have already resolved it; one read + one stat
+    # beats a stat per PATH entry.
+    try:
+        with open(_CACHED_CLI_PATH) as f:
+            p = f.read().strip()
+        if p and os.path.exists(p):
+            _TARGET_CLI_PATH = p
+            return _TARGET_CLI_PATH
+    except OSError:
+        pass
+
+    target_cli = "garmindb_cli.py"
+    path_dirs = os.environ.get("PATH", "").split(os.pathsep)
+    # Add /usr/local/bin explicitly as seen in logs
+    if "/usr/local/bin" not in path_dirs:
+        path_dirs.append("/usr/local/bin")
+
+    for d in path_dirs:
+        p = os.path.join(d, target_cli)
+        if os.path.exists(p):
+            _TARGET_CLI_PATH = p
+            # Persist only a path that actually exists, never the fallback.
+            try:
+                os.makedirs(GARMINDB_DIR, exist_ok=True)
+                with open(_CACHED_CLI_PATH, 'w') as f:
+                    f.write(p)
+            except OSError:
+                pass
+            break
+    else:
+        # Fallback based on previous error log
+        _TARGET_CLI_PATH = "/usr/local/bin/garmindb_cli.py"
+
+    return _TARGET_CLI_PATH
+
+def _import_garth():
+    """Import garth (deferred -- it drags in requests/urllib3/etc.), exiting
+    with a friendly message instead of a raw traceback when it is missing."""
+    try:
+        import garth
+    except ImportError:
+        _log("[WRAPPER] Error: 'garth' module not found. Is it installed?")
+        _flush_log()
+        sys.exit(1)
+    return garth
+
+def _resume_session():
+    """Try to reuse the saved garth session. Returns True when the in-process
+    garth.client is authenticated and ready to hand to garmindb."""
+    if _session_recently_validated():
+        # Validated within the TTL: the tokens still have to be resumed
+        # in-process (garmindb expects a single base64 session file and can
+        # never load the directory garth.save writes), but the sentinel lets
+        # us skip the username probe and its network round-trip.
+        garth = _import_garth()
+        try:
+            garth.resume(SESSION_DIR)
+            _log("[WRAPPER] Session validated recently, skipping probe.")
+            return True
+        except Exception as e:
+            _invalidate_session_sentinel()
+            _log(f"[WRAPPER] Failed to resume session: {e}")
+            return False
+
+    # A resume with dead tokens is doomed (and the username probe can even
+    # cost a network round-trip inside garth), so peek at the expiry first
+    # and go straight to login instead.
+    if not _token_still_fresh():
+        _log("[WRAPPER] Saved tokens expired past refresh window; skipping resume.")
+        return False
+
+    garth = _import_garth()
     try:
         if os.path.exists(SESSION_DIR):
             garth.resume(SESSION_DIR)
-            # rapid check?
+            # garth's username property hits the profile endpoint and raises
+            # GarthHTTPError (or KeyError/AssertionError) on a dead session,
+            # never AttributeError -- so the probe needs a broad catch to
+            # fall through to interactive login instead of crashing.
             try:
-                garth.client.username
-                session_valid = True
-                print("[WRAPPER] Session resumed successfully.")
-            except:
-                print("[WRAPPER] Session invalid/expired.")
+                session_valid = bool(getattr(garth, 'client', None) is not None
+                                     and getattr(garth.client, 'username', None))
+            except Exception:
+                session_valid = False
+            if session_valid:
+                _mark_session_validated()
+                _log("[WRAPPER] Session resumed successfully.")
+                return True
+            _invalidate_session_sentinel()
+            _log("[WRAPPER] Session invalid/expired.")
+    except (OSError, ValueError, TypeError) as e:
+        # ValueError covers json.JSONDecodeError without importing json here;
+        # TypeError covers garth.resume choking on a schema-mismatched token
+        # file (dataclass **kwargs).
+        _log(f"[WRAPPER] Failed to resume session: {e}")
+    return False
+
+def _interactive_login():
+    """Prompt for credentials over the server.js pipe and log in via garth.
+
+    Returns (email, password) on success; exits the process on failure.
+    """
+    garth = _import_garth()
+
+    _log("[WRAPPER] No valid session found. Starting interactive login...")
+
+    # PROMPTS MUST MATCH THE REGEX IN SERVER.JS
+    # "Username: " and "Password: "
+
+    _flush_log()
+    print("Username:")
+    sys.stdout.flush()
+    email = _read_line()
+    if not email:
+        _log("[WRAPPER] No email provided. Aborting.")
+        _flush_log()
+        sys.exit(1)
+
+    print("Password:")
+    sys.stdout.flush()
+    password = _read_line()
+    if not password:
+        _log("[WRAPPER] No password provided. Aborting.")
+        _flush_log()
+        sys.exit(1)
+
+    try:
+        # garth.login handles MFA interactive prompts if needed (hopefully prints to stdout)
+        garth.login(email, password)
+        _log("[WRAPPER] Login successful!")
+
+        # Save session for GarminDB to use
+        os.makedirs(SESSION_DIR, exist_ok=True)
+        garth.save(SESSION_DIR)
+        _mark_session_validated()
+        _log(f"[WRAPPER] Session saved to {SESSION_DIR}")
     except Exception as e:
-        print(f"[WRAPPER] Failed to resume session: {e}")
+        _log(f"[WRAPPER] Login failed: {e}")
+        _flush_log()
+        sys.exit(1)
 
-    # 2. If not valid, valid, perform login
-    if not session_valid:
-        print("[WRAPPER] No valid session found. Starting interactive login...")
-        
-        # PROMPTS MUST MATCH THE REGEX IN SERVER.JS
-        # "Username: " and "Password: "
-        
-        print("Username:")
-        sys.stdout.flush()
-        email = sys.stdin.readline().strip()
-        if not email:
-            print("[WRAPPER] No email provided. Aborting.")
-            sys.exit(1)
-            
-        print("Password:")
-        sys.stdout.flush()
-        password = sys.stdin.readline().strip()
-        if not password:
-            print("[WRAPPER] No password provided. Aborting.")
-            sys.exit(1)
+    return email, password
 
+def _write_config(email, password):
+    """Write credentials and sane data defaults to GarminConnectConfig.json.
+
+    CRITICAL FIX: GarminDB strictly requires credentials in the config file
+    or it fails with "Missing config" and crashes. Since we have the valid
+    credentials here, we write them to the config.
+    """
+    config_file = os.path.join(GARMINDB_DIR, "GarminConnectConfig.json")
+    try:
+        import json
+
+        # Open directly and handle the miss -- one syscall instead of
+        # an exists() stat followed by the open.
         try:
-            # garth.login handles MFA interactive prompts if needed (hopefully prints to stdout)
-            garth.login(email, password)
-            print("[WRAPPER] Login successful!")
-            
-            # Save session for GarminDB to use
-            if not os.path.exists(SESSION_DIR):
-                os.makedirs(SESSION_DIR)
-            garth.save(SESSION_DIR)
-            print(f"[WRAPPER] Session saved to {SESSION_DIR}")
-
-            # CRITICAL FIX: GarminDB strictly requires credentials in the config file
-            # or it fails with "Missing config" and crashes.
-            # Since we have the valid credentials here, we write them to the config.
-            config_file = os.path.join(GARMINDB_DIR, "GarminConnectConfig.json")
-            try:
-                config_data = {}
-                if os.path.exists(config_file):
-                    with open(config_file, 'r') as f:
-                        try:
-                            config_data = json.load(f)
-                        except json.JSONDecodeError:
-                            config_data = {}
-                
-                # Ensure structure exists
-                if "credentials" not in config_data:
-                    config_data["credentials"] = {}
-                
-                config_data["credentials"]["username"] = email
-                config_data["credentials"]["password"] = password
-
-                # Fix for "unsupported operand type(s) for -: 'datetime.date' and 'NoneType'"
-                # This happens if the DB is empty and no start date is configured.
-                if "data" not in config_data:
-                    config_data["data"] = {}
-                
-                # Set defaults if missing
-                if "download_days" not in config_data["data"]:
-                    config_data["data"]["download_days"] = 90
-                
-                # It seems stat_start_date looks for specific config or defaults.
-                # Providing a sane default for 'start_date' might help if the tool looks effectively for it.
-                # We'll set it to a reasonable past date.
-                default_start = "2023-01-01"
-                
-                if "start_date" not in config_data["data"]:
-                    config_data["data"]["start_date"] = default_start
-                    
-                # Shotgun approach: Inject into common stat blocks to ensure stat_start_date(stat) finds it.
-                # Common stats: monitoring, activities, sleep, weight, rhr
-                stats = ["monitoring", "activities", "sleep", "weight", "rhr", "steps", "floors", "intensity_minutes"]
-                for stat in stats:
-                    if stat not in config_data:
-                        config_data[stat] = {}
-                    if "start_date" not in config_data[stat]:
-                        config_data[stat]["start_date"] = default_start
-                
-                with open(config_file, 'w') as f:
-                    json.dump(config_data, f, indent=4)
-                print(f"[WRAPPER] Credentials and comprehensive defaults written to {config_file}")
-                
-                # Verify content (redacted)
-                with open(config_file, 'r') as f:
-                    verify_data = json.load(f)
-                    user = verify_data.get('credentials', {}).get('username')
-                    print(f"[WRAPPER] VERIFICATION: Config file contains username: {user}")
-                
-            except Exception as e:
-                print(f"[WRAPPER] Warning: Failed to write config file: {e}")
-            
-        except Exception as e:
-            print(f"[WRAPPER] Login failed: {e}")
-            sys.exit(1)
-
-    # 3. Launch the actual CLI tool IN-PROCESS
-    # This ensures the `garth` module (and its authenticated session) is shared.
-    
-    import runpy
-    
+            with open(config_file, 'r') as f:
+                config_data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            config_data = {}
+
+        # Ensure structure exists
+        if "credentials" not in config_data:
+            config_data["credentials"] = {}
+
+        config_data["credentials"]["username"] = email
+        config_data["credentials"]["password"] = password
+
+        # Fix for "unsupported operand type(s) for -: 'datetime.date' and 'NoneType'"
+        # This happens if the DB is empty and no start date is configured.
+        if "data" not in config_data:
+            config_data["data"] = {}
+
+        # Set defaults if missing
+        if "download_days" not in config_data["data"]:
+            config_data["data"]["download_days"] = 90
+
+        # It seems stat_start_date looks for specific config or defaults.
+        # Providing a sane default for 'start_date' might help if the tool looks effectively for it.
+        # We'll set it to a reasonable past date.
+        default_start = "2023-01-01"
+
+        if "start_date" not in config_data["data"]:
+            config_data["data"]["start_date"] = default_start
+
+        # Shotgun approach: Inject into common stat blocks to ensure stat_start_date(stat) finds it.
+        # Common stats: monitoring, activities, sleep, weight, rhr
+        stats = ["monitoring", "activities", "sleep", "weight", "rhr", "steps", "floors", "intensity_minutes"]
+        for stat in stats:
+            if stat not in config_data:
+                config_data[stat] = {}
+            if "start_date" not in config_data[stat]:
+                config_data[stat]["start_date"] = default_start
+
+        # os.open with mode 0o600 keeps the plaintext credentials
+        # owner-only from the moment the file exists -- no umask
+        # window, no follow-up chmod.
+        # Write to a temp file and rename into place so a wrapper
+        # killed mid-write can never leave a half-written config that
+        # the next run would fail to parse.
+        tmp_file = config_file + ".tmp"
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            # Compact dump: only garmindb parses this file, and the
+            # indent=4 path in CPython is pure-Python and much slower.
+            f.write(json.dumps(config_data, separators=(",", ":")))
+        os.replace(tmp_file, config_file)
+        _log(f"[WRAPPER] Credentials and comprehensive defaults written to {config_file}")
+
+        # The write either succeeded or raised, so the in-memory dict
+        # is authoritative -- no need to re-open and re-parse the file.
+        _log(f"[WRAPPER] VERIFICATION: Config file contains username: {config_data['credentials']['username']}")
+
+        # Don't keep the plaintext password reachable through the dict once
+        # it is on disk.
+        config_data["credentials"]["password"] = None
+        config_data = None
+
+    except Exception as e:
+        _log(f"[WRAPPER] Warning: Failed to write config file: {e}")
+
+def _launch_inprocess(target_path):
+    """Run garmindb_cli.py in this process via runpy, sharing the garth session."""
+    # Monkey-patch garth.Client to return our authenticated global client.
+    # This prevents garmindb from creating a new, unauthenticated instance --
+    # its own resume wants a single base64 session file, not the directory
+    # garth.save writes, so it could never load our session and would fall
+    # back to a full credential login.
+    import garth
+
+    _log("[WRAPPER] Monkey-patching garth.Client...")
+
+    class AuthenticatedClientProxy:
+        def __new__(cls, *args, **kwargs):
+            # Always return the global 'garth.client' which we just logged in.
+            return garth.client
+
+    garth.Client = AuthenticatedClientProxy
+
+    _log(f"[WRAPPER] Launching in-process: {target_path}")
+    _log(f"[WRAPPER] Args: {sys.argv}")
+    _log("---------------------------------------------------")
+    _flush_log()
+    try:
+        import runpy
+        runpy.run_path(target_path, run_name='__main__')
+    except SystemExit as e:
+        # Propagate the CLI's exit code untouched.
+        sys.exit(e.code)
+    except Exception as e:
+        _log(f"[WRAPPER] Execution failed: {e}")
+        _flush_log()
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+def _launch_execvp(target_path):
+    """Legacy launcher: replace this process with a fresh interpreter running the CLI."""
+    _log(f"[WRAPPER] Launching via exec: {target_path}")
+    _log("---------------------------------------------------")
+    _flush_log()
+    os.execvp(sys.executable, [sys.executable, target_path] + sys.argv[1:])
+
+def main():
+    # Die immediately on a closed pipe (server.js tearing the child down)
+    # instead of unwinding Python through BrokenPipeError and printing a
+    # traceback at shutdown. SIGPIPE doesn't exist on Windows.
+    import signal
+    if hasattr(signal, 'SIGPIPE'):
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+    # Line-buffered stdout gets prompt bytes onto the pipe as each line is
+    # written, without needing a flush call after every print.
+    try:
+        sys.stdout.reconfigure(line_buffering=True)
+    except (AttributeError, ValueError):
+        pass
+
+    _log("[WRAPPER] Starting Garmin Auth Wrapper...")
+
+    # 1. Try to resume existing session
+    session_valid = _resume_session()
+
+    # 2. If not valid, perform login
+    if not session_valid:
+        email, password = _interactive_login()
+        _write_config(email, password)
+        # main()'s frame stays alive for the whole in-process CLI run, so
+        # drop the plaintext references now that the config is written.
+        del email, password
+
+    # 3. Launch the actual CLI tool.
     # Locate the script
-    target_cli = "garmindb_cli.py"
     target_path = None
-    
+
     # Try finding it in path
     if len(sys.argv) > 1 and sys.argv[1].endswith(".py"):
          # If user passed the script path explicitly
@@ -145,65 +401,37 @@ def main():
              target_path = candidate
              # Remove wrapper from argv so CLI sees [script, flags...]
              sys.argv.pop(0)
-    
-    if not target_path:
-        # Check common locations or PATH
-        path_dirs = os.environ.get("PATH", "").split(os.pathsep)
-        # Add /usr/local/bin explicitly as seen in logs
-        if "/usr/local/bin" not in path_dirs:
-            path_dirs.append("/usr/local/bin")
-            
-        for d in path_dirs:
-            p = os.path.join(d, target_cli)
-            if os.path.exists(p):
-                target_path = p
-                break
-    
+
     if not target_path:
-        # Fallback based on previous error log
-        target_path = "/usr/local/bin/garmindb_cli.py"
-    
-    # Monkey-patch garth.Client to return our authenticated global client
-    # This prevents garmindb from creating a new, unauthenticated instance.
-    print("[WRAPPER] Monkey-patching garth.Client...")
-    
-    # Store original just in case (though we won't use it)
-    _OriginalClient = garth.Client 
-    
-    class AuthenticatedClientProxy:
-        def __new__(cls, *args, **kwargs):
-            # Always return the global 'garth.client' which we just logged in.
-            return garth.client
-            
-    garth.Client = AuthenticatedClientProxy
-    
-    print(f"[WRAPPER] Launching in-process: {target_path}")
-    print(f"[WRAPPER] Args: {sys.argv}")
-    print("---------------------------------------------------")
-    try:
-        # Patch sys.argv to look like: [garmindb_cli.py, --a, --b...]
-        # Currently sys.argv[0] is garmin_auth_wrapper.py (unless popped above)
-        # If we didn't pop above (because arg1 turned out to be the script name we found in PATH), we should replace argv[0]
-        if sys.argv[0].endswith("garmin_auth_wrapper.py"):
-             sys.argv[0] = target_path
-             # If the second arg was the script name (e.g. wrapper.py garmindb_cli.py ...), remove it to avoid dup
-             if len(sys.argv) > 1 and "garmindb_cli" in sys.argv[1]:
-                 sys.argv.pop(1)
-        
-        # Inject -f if missing, just in case
-        config_dir_path = GARMINDB_DIR
-        if "-f" not in sys.argv:
-             print(f"[WRAPPER] Injecting -f {config_dir_path}")
-             sys.argv.insert(1, config_dir_path)
-             sys.argv.insert(1, "-f")
+        target_path = _resolve_target_cli()
 
-        runpy.run_path(target_path, run_name='__main__')
-        
-    except Exception as e:
-        print(f"[WRAPPER] Execution failed: {e}")
-        import traceback
-        traceback.print_exc()
-        sys.exit(1)
+    # Patch sys.argv to look like: [garmindb_cli.py, --a, --b...]
+    # Currently sys.argv[0] is garmin_auth_wrapper.py (unless popped above)
+    # If we didn't pop above (because arg1 turned out to be the script name we found in PATH), we should replace argv[0]
+    if sys.argv[0].endswith("garmin_auth_wrapper.py"):
+         sys.argv[0] = target_path
+         # If the second arg was the script name (e.g. wrapper.py garmindb_cli.py ...), remove it to avoid dup
+         if len(sys.argv) > 1 and "garmindb_cli" in sys.argv[1]:
+             sys.argv.pop(1)
+
+    # Inject -f if missing, just in case
+    config_dir_path = GARMINDB_DIR
+    if "-f" not in sys.argv:
+         _log(f"[WRAPPER] Injecting -f {config_dir_path}")
+         sys.argv.insert(1, config_dir_path)
+         sys.argv.insert(1, "-f")
+
+    # In-process runpy is the default; GARMIN_WRAPPER_MODE=exec restores the
+    # old process-replacement behaviour as an escape hatch.
+    if os.environ.get("GARMIN_WRAPPER_MODE", "runpy") == "exec":
+        _launch_execvp(target_path)
+    else:
+        _launch_inprocess(target_path)
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        # Never let batching swallow the diagnostics that explain a failure:
+        # flush whatever is pending even when an exception escapes main().
+        _flush_log()